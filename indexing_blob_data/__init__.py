@@ -1,13 +1,58 @@
 import os
 import re
+import asyncio
+import csv
+import hashlib
+import io
 import logging
 import json
-from typing import List
+import string
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from typing import Iterator, List
 import azure.functions as func
 
+# Optional extraction dependencies, imported once at module load so pool
+# workers inherit them via fork instead of re-running import machinery
+# on every call.
+try:
+    import fitz
+except ImportError:
+    fitz = None
+try:
+    from docx import Document
+except ImportError:
+    Document = None
+try:
+    from pptx import Presentation
+except ImportError:
+    Presentation = None
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+
+# === CLIENT TRANSPORT ===
+def make_transport():
+# One keep-alive session with an enlarged urllib3 pool, shared by every sync
+# client so TLS handshakes and connections are amortized across all stages
+# (and download threads do not hit "Connection pool is full" churn).
+    try:
+        import requests
+        from requests.adapters import HTTPAdapter
+        from azure.core.pipeline.transport import RequestsTransport
+    except ImportError:
+        return None
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=128, pool_maxsize=128)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return RequestsTransport(session=session)
+
 
 # === BLOB OPERATIONS ===
-def download_blobs(connection_string, container_name, local_folder=None):
+def download_blobs(connection_string, container_name, local_folder=None, transport=None):
     try:
         from azure.storage.blob import BlobServiceClient
     except ImportError:
@@ -18,18 +63,37 @@ def download_blobs(connection_string, container_name, local_folder=None):
         local_folder = os.path.join(os.getenv("TMP", "/tmp"), "blobs")
     os.makedirs(local_folder, exist_ok=True)
 
-    blob_service = BlobServiceClient.from_connection_string(connection_string)
+    if transport is None:
+        transport = make_transport()
+
+    blob_service = BlobServiceClient.from_connection_string(
+        connection_string,
+        transport=transport,
+        connection_data_block_size=4 * 1024 * 1024,
+        max_single_get_size=4 * 1024 * 1024,
+        max_chunk_get_size=4 * 1024 * 1024,
+    )
     container = blob_service.get_container_client(container_name)
 
-    for blob in container.list_blobs():
-        file_path = os.path.join(local_folder, blob.name)
+    def _download(name):
+        file_path = os.path.join(local_folder, name)
         os.makedirs(os.path.dirname(file_path), exist_ok=True)
-        try:
-            blob_client = container.get_blob_client(blob)
-            with open(file_path, "wb") as f:
-                f.write(blob_client.download_blob().readall())
-        except Exception as e:
-            logging.warning(f"Failed to download blob {blob.name}: {e}")
+        blob_client = container.get_blob_client(name)
+        # readinto() streams chunks straight into the file handle instead of
+        # buffering the whole blob in memory like readall() would.
+        with open(file_path, "wb") as f:
+            blob_client.download_blob(max_concurrency=8).readinto(f)
+
+    with ThreadPoolExecutor(max_workers=64) as executor:
+        # list_blob_names() skips the per-blob properties payload, which makes
+        # listing large containers several times faster than list_blobs().
+        futures = {executor.submit(_download, name): name
+                   for name in container.list_blob_names()}
+        for future in as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                logging.warning(f"Failed to download blob {futures[future]}: {e}")
 
     logging.info(f"Downloaded blobs to {local_folder}")
     return local_folder
@@ -37,183 +101,307 @@ def download_blobs(connection_string, container_name, local_folder=None):
 
 # === TEXT EXTRACTION ===
 def extract_text_from_pdf(path):
-    try:
-        import fitz
-    except ImportError:
+    if fitz is None:
         logging.warning("PyMuPDF not installed, skipping PDF extraction.")
         return ""
     try:
-        text = []
+        # Skip the ligature/space normalization the tokenizer does not need,
+        # and write pages into one growable buffer instead of a list + join.
+        flags = fitz.TEXT_PRESERVE_WHITESPACE | fitz.TEXT_INHIBIT_SPACES
+        buf = io.StringIO()
         with fitz.open(path) as doc:
             for page in doc:
-                text.append(page.get_text("text"))
-        return "\n".join(text)
+                buf.write(page.get_text("text", flags=flags))
+                buf.write("\n")
+        return buf.getvalue()
     except Exception as e:
         logging.warning(f"Failed to extract PDF {path}: {e}")
         return ""
 
 
 def extract_text_from_docx(path):
-    try:
-        from docx import Document
-    except ImportError:
+    if Document is None:
         logging.warning("python-docx not installed, skipping DOCX extraction.")
         return ""
     try:
         doc = Document(path)
-        return "\n".join([p.text for p in doc.paragraphs])
+        return "\n".join(p.text for p in doc.paragraphs)
     except Exception as e:
         logging.warning(f"Failed to extract DOCX {path}: {e}")
         return ""
 
 
 def extract_text_from_pptx(path):
-    try:
-        from pptx import Presentation
-    except ImportError:
+    if Presentation is None:
         logging.warning("python-pptx not installed, skipping PPTX extraction.")
         return ""
     try:
-        text = []
+        # Write into one growable buffer instead of keeping every shape's
+        # text alive in a list until the final join.
+        buf = io.StringIO()
         prs = Presentation(path)
         for slide in prs.slides:
             for shape in slide.shapes:
                 if hasattr(shape, "text"):
-                    text.append(shape.text)
-        return "\n".join(text)
+                    buf.write(shape.text)
+                    buf.write("\n")
+        return buf.getvalue()
     except Exception as e:
         logging.warning(f"Failed to extract PPTX {path}: {e}")
         return ""
 
 
 def extract_text_from_xlsx(path):
-    try:
-        import openpyxl
-    except ImportError:
+    if openpyxl is None:
         logging.warning("openpyxl not installed, skipping XLSX extraction.")
         return ""
+    wb = None
     try:
-        text = []
-        wb = openpyxl.load_workbook(path, data_only=True)
+        buf = io.StringIO()
+        # read_only streams rows through the SAX reader instead of building
+        # the whole workbook object model in memory.
+        wb = openpyxl.load_workbook(path, data_only=True, read_only=True)
         for sheet in wb.worksheets:
             for row in sheet.iter_rows(values_only=True):
-                row_text = [str(cell) for cell in row if cell]
+                row_text = " ".join(str(cell) for cell in row if cell)
                 if row_text:
-                    text.append(" ".join(row_text))
-        return "\n".join(text)
+                    buf.write(row_text)
+                    buf.write("\n")
+        return buf.getvalue()
     except Exception as e:
         logging.warning(f"Failed to extract XLSX {path}: {e}")
         return ""
+    finally:
+        if wb is not None:
+            wb.close()
 
 
 def extract_text_from_csv(path):
     try:
-        import pandas as pd
-    except ImportError:
-        logging.warning("pandas not installed, skipping CSV extraction.")
-        return ""
-    try:
-        df = pd.read_csv(path)
-        return df.to_string()
+        with open(path, newline="") as f:
+            return "\n".join(" ".join(cell for cell in row if cell)
+                             for row in csv.reader(f))
     except Exception as e:
         logging.warning(f"Failed to extract CSV {path}: {e}")
         return ""
 
 
+_EXTRACTORS = {
+    ".pdf": extract_text_from_pdf,
+    ".docx": extract_text_from_docx,
+    ".pptx": extract_text_from_pptx,
+    ".xlsx": extract_text_from_xlsx,
+    ".csv": extract_text_from_csv,
+}
+
+
 def extract_text(path):
-    path_lower = path.lower()
-    if path_lower.endswith(".pdf"):
-        return extract_text_from_pdf(path)
-    elif path_lower.endswith(".docx"):
-        return extract_text_from_docx(path)
-    elif path_lower.endswith(".pptx"):
-        return extract_text_from_pptx(path)
-    elif path_lower.endswith(".xlsx"):
-        return extract_text_from_xlsx(path)
-    elif path_lower.endswith(".csv"):
-        return extract_text_from_csv(path)
-    return ""
+    extractor = _EXTRACTORS.get(os.path.splitext(path)[1].lower())
+    if extractor is None:
+        return ""
+    return extractor(path)
 
 
 # === CHUNKING ===
-def chunk_text(text: str, chunk_size: int = 800, overlap: int = 100) -> List[str]:
-    tokens = text.split()
-    chunks, start = [], 0
-    while start < len(tokens):
-        end = min(start + chunk_size, len(tokens))
-        chunks.append(" ".join(tokens[start:end]))
+def chunk_text(text: str, chunk_size: int = 800, overlap: int = 100) -> Iterator[str]:
+    # Slice the original string at token offsets instead of materializing a
+    # token list and re-joining it per chunk: overlapping joins did
+    # O(N * N/step) character copies, the slices here are O(N) total.
+    # Yielding chunks one at a time keeps only the current slice alive;
+    # consumers feed them straight into the bounded upload queue.
+    spans = [m.span() for m in re.finditer(r'\S+', text)]
+    start = 0
+    while start < len(spans):
+        end = min(start + chunk_size, len(spans))
+        yield text[spans[start][0]:spans[end - 1][1]]
         start += chunk_size - overlap
-    return chunks
 
 
 # === SEARCH INDEX ===
-def ensure_index(search_endpoint, search_key, index_name):
+def ensure_index(search_endpoint, search_key, index_name, transport=None):
     try:
         from azure.core.credentials import AzureKeyCredential
+        from azure.core.exceptions import ResourceNotFoundError
         from azure.search.documents.indexes import SearchIndexClient
         from azure.search.documents.indexes.models import SearchIndex, SimpleField, SearchFieldDataType, SearchableField
     except ImportError:
         logging.warning("Azure Search SDK not installed, skipping index creation.")
         return
     print("inside ensure_index")
-    index_client = SearchIndexClient(search_endpoint, AzureKeyCredential(search_key))
-    if index_name not in [idx.name for idx in index_client.list_indexes()]:
-        fields = [
-            SimpleField(name="id", type=SearchFieldDataType.String, key=True),
-            SearchableField(name="text", type=SearchFieldDataType.String)
-        ]
-        index = SearchIndex(name=index_name, fields=fields)
-        index_client.create_index(index)
-        logging.info(f"Created index: {index_name}")
-    else:
+    index_client = SearchIndexClient(search_endpoint, AzureKeyCredential(search_key), transport=transport)
+    try:
+        # Single GET for the one index we care about, instead of paging
+        # through every index in the service with list_indexes().
+        index_client.get_index(index_name)
         logging.info(f"Index {index_name} already exists.")
-
-
-def upload_documents(search_endpoint, search_key, index_name, docs, batch_size=500):
-    if not docs:
-        print("No documents to upload.")
         return
+    except ResourceNotFoundError:
+        pass
+    fields = [
+        SimpleField(name="id", type=SearchFieldDataType.String, key=True),
+        SearchableField(name="text", type=SearchFieldDataType.String)
+    ]
+    index = SearchIndex(name=index_name, fields=fields)
+    index_client.create_index(index)
+    logging.info(f"Created index: {index_name}")
+
+
+# Allowed characters for Azure Search document keys; everything else maps to "_".
+_ID_SAFE = frozenset(string.ascii_letters + string.digits + "_-=")
+_ID_TABLE = {cp: (cp if chr(cp) in _ID_SAFE else ord("_")) for cp in range(128)}
+_ID_RE = re.compile(r'[^A-Za-z0-9_\-=]')
 
+def sanitize_id(s: str) -> str:
+# Replace invalid characters with underscore
+    if s.isascii():
+        return s.translate(_ID_TABLE)
+    return _ID_RE.sub("_", s)
+
+
+def process_file(fpath) -> List[dict]:
+# Extract, chunk and id one file inside the pool worker, so only the small
+# chunk dicts cross the process boundary instead of the full document text.
+    text = extract_text(fpath)
+    if not text.strip():
+        return []
+
+    docs = []
+    for chunk in chunk_text(text):
+        # The content hash alone is the document key: identical chunks from
+        # any file collapse to one deterministic id, so re-running an
+        # unchanged corpus is a pure merge-or-upload no-op.
+        h = hashlib.blake2b(chunk.encode(), digest_size=16).hexdigest()
+        docs.append({"id": h, "text": chunk})
+    return docs
+
+
+# === PIPELINE ===
+def iter_files(root):
+# scandir exposes is_file()/is_dir() from the cached stat, unlike os.walk
+# which stats every entry again to classify it.
+    with os.scandir(root) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_files(entry.path)
+            elif entry.is_file():
+                yield entry.path
+
+
+def run_pipeline(folder, search_endpoint, search_key, index_name, batch_size=1000):
+# Overlap CPU-bound extraction with upload round-trips: pool workers feed
+# chunk dicts into a bounded queue while the uploader drains it, so the
+# first batch is uploading while later files are still being extracted.
     try:
         from azure.core.credentials import AzureKeyCredential
-        from azure.search.documents import SearchClient
+        from azure.search.documents.aio import SearchClient
     except ImportError:
         logging.warning("Azure Search SDK not installed, skipping document upload.")
-        return
-
-    print("inside upload_documents")
-
-    search_client = SearchClient(search_endpoint, index_name, AzureKeyCredential(search_key))
-
-    for i in range(0, len(docs), batch_size):
-        batch = docs[i:i + batch_size]
-        try:
-            result = search_client.upload_documents(documents=batch)
-            print(f"Uploaded batch {i // batch_size + 1} ({len(batch)} docs) → Result: {result}")
-        except Exception as e:
-            logging.error(f"Failed to upload batch {i // batch_size + 1}: {e}")
-
-def sanitize_id(s: str) -> str:
-# Replace invalid characters with underscore
-    return re.sub(r'[^A-Za-z0-9_\-=]', "_", s)
+        return 0
+
+    # Skip unsupported files (images, zips, ...) before they reach a worker.
+    tasks = [fpath for fpath in iter_files(folder)
+             if os.path.splitext(fpath)[1].lower() in _EXTRACTORS]
+
+    async def _run():
+        loop = asyncio.get_running_loop()
+        # Ingestion throughput is bounded by concurrent bulk requests, not
+        # batch size, so keep several batches in flight under a semaphore.
+        sem = asyncio.Semaphore(8)
+        # Bounded queue caps memory at a few batches instead of the corpus.
+        docs_q = asyncio.Queue(maxsize=4 * batch_size)
+        stats = {"uploaded": 0, "batches": 0}
+        seen_hashes = set()
+
+        async with SearchClient(search_endpoint, index_name, AzureKeyCredential(search_key)) as search_client:
+
+            async def _upload(batch):
+                stats["batches"] += 1
+                batch_num = stats["batches"]
+                try:
+                    result = await search_client.merge_or_upload_documents(documents=batch)
+                    stats["uploaded"] += len(batch)
+                    print(f"Uploaded batch {batch_num} ({len(batch)} docs) → Result: {result}")
+                except Exception as e:
+                    logging.error(f"Failed to upload batch {batch_num}: {e}")
+                finally:
+                    sem.release()
+
+            async def _enqueue(docs):
+                for doc in docs:
+                    # Boilerplate headers/footers yield byte-identical chunks;
+                    # the content-hash id already collapses them in the index,
+                    # dedup here just avoids re-sending one within a run.
+                    if doc["id"] in seen_hashes:
+                        continue
+                    seen_hashes.add(doc["id"])
+                    await docs_q.put(doc)
+
+            async def _producer():
+                # Extraction is CPU-bound native code (PyMuPDF, openpyxl, ...);
+                # processes scale it across cores and isolate crashes on bad files.
+                # Submit in a bounded window and drop each future once its docs
+                # are enqueued, so finished results never pile up in memory.
+                with ProcessPoolExecutor(max_workers=os.cpu_count()) as executor:
+                    window = 2 * (os.cpu_count() or 1)
+                    pending = set()
+                    for task in tasks:
+                        if len(pending) >= window:
+                            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                            for future in done:
+                                await _enqueue(future.result())
+                        pending.add(loop.run_in_executor(executor, process_file, task))
+                    while pending:
+                        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                        for future in done:
+                            await _enqueue(future.result())
+
+            async def _uploader():
+                uploads = set()
+                batch = []
+
+                async def _launch(batch):
+                    # Take the slot before spawning the task: with all 8 busy
+                    # this blocks the drain loop, the queue fills and the
+                    # producer stalls, giving back-pressure end to end.
+                    await sem.acquire()
+                    upload_task = asyncio.create_task(_upload(batch))
+                    uploads.add(upload_task)
+                    upload_task.add_done_callback(uploads.discard)
+
+                while True:
+                    doc = await docs_q.get()
+                    if doc is None:
+                        break
+                    batch.append(doc)
+                    if len(batch) >= batch_size:
+                        await _launch(batch)
+                        batch = []
+                if batch:
+                    await _launch(batch)
+                if uploads:
+                    await asyncio.gather(*uploads)
+
+            uploader_task = asyncio.create_task(_uploader())
+            await _producer()
+            await docs_q.put(None)
+            await uploader_task
+
+        logging.info("Prepared %d chunks from %d files", len(seen_hashes), len(tasks))
+        return stats["uploaded"]
+
+    return asyncio.run(_run())
 
 # === MAIN FUNCTION ===
 def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info("Trigger received, starting blob processing pipeline.")
 
     try:
-        # Environment variables
-        connection_string = os.getenv("BLOB_CONNECTION_STRING")
-        container_name = os.getenv("BLOB_CONTAINER_NAME")
-        search_endpoint = os.getenv("SEARCH_ENDPOINT")
-        search_key = os.getenv("SEARCH_KEY")
-        index_name = os.getenv("SEARCH_INDEX")
-        AZURE_OPENAI_ENDPOINT = os.getenv("AZURE_OPENAI_ENDPOINT")
-        AZURE_OPENAI_KEY = os.getenv("AZURE_OPENAI_KEY")
-        AZURE_OPENAI_DEPLOYMENT = os.getenv("AZURE_OPENAI_DEPLOYMENT")
-        print("connection string: " +connection_string,"\n Container name: " +container_name,"\n search_endpoint name: " +search_endpoint,"\n search_key name: " +search_key,"\n index_name name: " +index_name,"\n AZURE_OPENAI_ENDPOINT name: " +AZURE_OPENAI_ENDPOINT,"\n AZURE_OPENAI_KEY name: " +AZURE_OPENAI_KEY,"\n AZURE_OPENAI_DEPLOYMENT name: " +AZURE_OPENAI_DEPLOYMENT)
-        missing_vars = [v for v in ["BLOB_CONNECTION_STRING","BLOB_CONTAINER_NAME","SEARCH_ENDPOINT","SEARCH_KEY","SEARCH_INDEX"]
-                        if not os.getenv(v)]
+        # Environment variables: check presence first, and never log values -
+        # they are connection strings and API keys.
+        required_vars = ["BLOB_CONNECTION_STRING","BLOB_CONTAINER_NAME","SEARCH_ENDPOINT","SEARCH_KEY","SEARCH_INDEX"]
+        logging.debug("env present: %s", {v: bool(os.getenv(v))
+                                          for v in required_vars + ["AZURE_OPENAI_ENDPOINT","AZURE_OPENAI_KEY","AZURE_OPENAI_DEPLOYMENT"]})
+        missing_vars = [v for v in required_vars if not os.getenv(v)]
         if missing_vars:
             logging.warning(f"Missing environment variables: {missing_vars}")
             return func.HttpResponse(
@@ -221,39 +409,27 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 status_code=400
             )
 
+        connection_string = os.getenv("BLOB_CONNECTION_STRING")
+        container_name = os.getenv("BLOB_CONTAINER_NAME")
+        search_endpoint = os.getenv("SEARCH_ENDPOINT")
+        search_key = os.getenv("SEARCH_KEY")
+        index_name = os.getenv("SEARCH_INDEX")
+
+        # One tuned transport shared by the blob and index clients; the async
+        # upload client manages its own aiohttp session inside the pipeline.
+        transport = make_transport()
+
         # Download blobs
-        folder = download_blobs(connection_string, container_name)
+        folder = download_blobs(connection_string, container_name, transport=transport)
         if not folder:
             return func.HttpResponse("Blob download failed or skipped.", status_code=500)
 
-        chunked_docs = []
-
-        for root, _, files in os.walk(folder):
-            for fname in files:
-                fpath = os.path.join(root, fname)
-                rel_path = os.path.relpath(fpath, folder)
-
-                text = extract_text(fpath)
-                if not text.strip():
-                    continue
-
-                chunks = chunk_text(text)
-                for i, chunk in enumerate(chunks):
-                    raw_id = f"{rel_path.replace(os.sep, '_')}_chunk_{i}"
-                    safe_id = sanitize_id(raw_id)
-
-                    doc = {
-                        "id": safe_id,
-                        "text": chunk
-                    }
-                    chunked_docs.append(doc)
-
-        # Ensure index exists and upload
-        ensure_index(search_endpoint, search_key, index_name)
-        upload_documents(search_endpoint, search_key, index_name, chunked_docs)
+        # Ensure index exists, then extract and upload concurrently
+        ensure_index(search_endpoint, search_key, index_name, transport=transport)
+        uploaded = run_pipeline(folder, search_endpoint, search_key, index_name)
 
         return func.HttpResponse(
-            json.dumps({"status": "success", "docs_uploaded": len(chunked_docs)}),
+            json.dumps({"status": "success", "docs_uploaded": uploaded}),
             headers={"Content-Type": "application/json"}
         )
 